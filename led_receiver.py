@@ -1,10 +1,10 @@
 #!/usr/bin/env python
-import time
 import sys
 import socket
 import struct
 import numpy as np
 import traceback
+from PIL import Image
 
 # Import the SampleBase class required for interacting with the LED matrix library
 try:
@@ -23,9 +23,13 @@ LISTEN_PORT = 8888
 # The expected dimensions of the binary matrix data sent from the sender
 EXPECTED_ROWS = 32
 EXPECTED_COLS = 32
+# Frame header sent before the pixels: rows and cols as little-endian 32-bit integers (8 bytes)
+FRAME_HEADER = struct.Struct('<ii')
+# Largest datagram read in one go; a valid frame is the header + EXPECTED_ROWS * EXPECTED_COLS / 8 pixel bytes
+MAX_DATAGRAM_SIZE = 4096
 
 # --- LED Color Mapping ---
-# Define RGB colors for the ON (255) and OFF (0) states received from the sender
+# Define RGB colors for the ON (1) and OFF (0) pixel bits received from the sender
 ON_COLOR = (255, 255, 255) # White light for 'ON' pixels
 OFF_COLOR = (0, 0, 0)      # Black/off for 'OFF' pixels
 
@@ -33,27 +37,32 @@ OFF_COLOR = (0, 0, 0)      # Black/off for 'OFF' pixels
 class SocketLEDReceiver(SampleBase):
     def __init__(self, *args, **kwargs):
         super(SocketLEDReceiver, self).__init__(*args, **kwargs)
-        # Matrix to store the current frame's pixel data to be displayed
+        # Matrix to store the current frame's pixel data to be displayed (1 = ON, 0 = OFF)
         self.display_matrix = np.full((EXPECTED_ROWS, EXPECTED_COLS), 0, dtype=np.uint8)
+        # RGB image buffer reused every frame and blitted to the canvas in a single call
+        self.img_buf = np.zeros((EXPECTED_ROWS, EXPECTED_COLS, 3), dtype=np.uint8)
+        # Color lookup table indexed by pixel state: 0 -> OFF_COLOR, 1 -> ON_COLOR
+        self.color_lut = np.array([OFF_COLOR, ON_COLOR], dtype=np.uint8)
+        # Receive buffer for one datagram (8-byte header + bit-packed pixels, with room to spare),
+        # filled in place with recvfrom_into
+        self.rx_buf = bytearray(MAX_DATAGRAM_SIZE)
         self.server_socket = None
         self.socket_listening = False
 
     def setup_socket(self):
-        """Sets up the server socket to listen for incoming connections."""
+        """Sets up the server socket to listen for incoming frames."""
         try:
-            # Create a TCP/IP socket
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Create a UDP socket: each frame arrives as a single datagram
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             # Allow reusing the address quickly after the script exits (useful for quick restarts)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            # Set a timeout for accepting connections. This prevents accept() from blocking forever,
+            # Set a timeout for receiving frames. This prevents recvfrom_into() from blocking forever,
             # allowing the main loop to continue and refresh the display even without new data.
             self.server_socket.settimeout(1.0)
             # Bind the socket to the configured host and port
             self.server_socket.bind((LISTEN_HOST, LISTEN_PORT))
-            # Enable the server to accept connections (1 pending connection queue size)
-            self.server_socket.listen(1)
             self.socket_listening = True
-            print(f"Listening for connections on {LISTEN_HOST}:{LISTEN_PORT}...")
+            print(f"Listening for frames on {LISTEN_HOST}:{LISTEN_PORT} (UDP)...")
         except socket.error as e:
             print(f"Failed to set up socket: {e}")
             self.socket_listening = False
@@ -61,58 +70,41 @@ class SocketLEDReceiver(SampleBase):
             print(f"An unexpected error occurred during socket setup: {e}")
             self.socket_listening = False
 
-    def receive_matrix_data(self, conn):
-        """Receives matrix dimensions and pixel data from the connected sender."""
+    def receive_matrix_data(self):
+        """Receives one datagram holding the matrix dimensions and pixel data from the sender."""
         try:
-            # Set a timeout for receiving data on the established connection
-            conn.settimeout(5.0)
-
-            # --- Receive Dimensions ---
-            # Expected 8 bytes (4 for rows, 4 for cols, little-endian integers)
-            dim_bytes = b''
-            while len(dim_bytes) < 8:
-                packet = conn.recv(8 - len(dim_bytes))
-                if not packet: # Connection closed by sender
-                    print("Connection closed by sender while receiving dimensions.")
-                    return None
-                dim_bytes += packet
-
-            # Unpack the 8 bytes into two little-endian integers (rows, cols)
-            rows, cols = struct.unpack('<ii', dim_bytes)
+            # Blocks for up to the socket timeout (1s) waiting for the next frame
+            nbytes, addr = self.server_socket.recvfrom_into(self.rx_buf)
+
+            # --- Parse Dimensions ---
+            # First 8 bytes (4 for rows, 4 for cols, little-endian integers), read straight from
+            # rx_buf with the precompiled header struct (no slicing, no temporary bytes objects)
+            if nbytes < FRAME_HEADER.size:
+                print(f"Received a runt datagram ({nbytes} bytes) from {addr}, ignoring it.")
+                return None
+
+            rows, cols = FRAME_HEADER.unpack_from(self.rx_buf, 0)
 
             # Validate received dimensions against expected dimensions
             if rows != EXPECTED_ROWS or cols != EXPECTED_COLS:
-                print(f"Received unexpected dimensions: {rows}x{cols}. Expected {EXPECTED_COLS}x{EXPECTED_ROWS}. Attempting to drain buffer.")
-                # Try to quickly read and discard remaining data for this incorrect frame
-                try: conn.settimeout(0.1); while True: drained_data = conn.recv(1024); if not drained_data: break
-                except: pass
+                print(f"Received unexpected dimensions: {rows}x{cols}. Expected {EXPECTED_COLS}x{EXPECTED_ROWS}. Ignoring frame.")
                 return None
 
-            # --- Receive Pixel Data ---
-            # Expected total bytes: rows * cols * 4 (since each pixel is sent as a 4-byte integer)
-            total_bytes_to_receive = rows * cols * 4
-            received_bytes = 0
-            pixel_data_bytes = b''
-
-            # Loop to ensure all expected pixel bytes are received
-            while received_bytes < total_bytes_to_receive:
-                chunk = conn.recv(total_bytes_to_receive - received_bytes)
-                if not chunk: # Connection closed by sender prematurely
-                    print(f"Connection closed by sender before receiving all pixel data ({received_bytes}/{total_bytes_to_receive} bytes received).")
-                    return None
-                pixel_data_bytes += chunk
-                received_bytes += len(chunk)
-
-            # Final check on received byte count (redundant but safe)
-            if received_bytes != total_bytes_to_receive:
-                print(f"Warning: Received incorrect total bytes ({received_bytes} vs {total_bytes_to_receive}). Data may be corrupted.")
+            # --- Check Pixel Data ---
+            # Expected total bytes: rows * cols / 8, rounded up (pixels are bit-packed, 8 per byte)
+            total_bytes_to_receive = (rows * cols + 7) // 8
+            pixel_bytes_received = nbytes - FRAME_HEADER.size
+            if pixel_bytes_received != total_bytes_to_receive:
+                print(f"Warning: Received incorrect total bytes ({pixel_bytes_received} vs {total_bytes_to_receive}). Ignoring frame.")
                 return None
 
             # --- Process Received Data ---
             try:
-                # Convert received bytes buffer into a numpy array of 32-bit integers, then to 8-bit unsigned integers (0 or 255)
-                flattened_data = np.frombuffer(pixel_data_bytes, dtype=np.int32).astype(np.uint8)
-                # Reshape the 1D array into the expected 2D matrix format
+                # Unpack the bit-packed pixel bytes after the header into one 0/1 value per pixel
+                packed_data = np.frombuffer(self.rx_buf, dtype=np.uint8, count=total_bytes_to_receive, offset=FRAME_HEADER.size)
+                flattened_data = np.unpackbits(packed_data, count=rows * cols)
+                # Reshape into the expected 2D matrix format. The 0/1 values are kept as-is
+                # since update_display uses them directly as color LUT indices.
                 received_matrix = flattened_data.reshape((rows, cols))
                 return received_matrix
             except Exception as e:
@@ -121,7 +113,7 @@ class SocketLEDReceiver(SampleBase):
                 return None
 
         except socket.timeout:
-            # This specific timeout happens if data stops arriving on an *established* connection
+            # No frame arrived within the timeout; the caller just refreshes the display
             return None
         except socket.error as e:
             print(f"Socket error during receive: {e}")
@@ -132,21 +124,34 @@ class SocketLEDReceiver(SampleBase):
             return None
 
     def update_display(self, canvas, matrix_data):
-        """Updates the LED matrix canvas based on the received matrix data (0 or 255 values)."""
+        """Updates the LED matrix canvas based on the received matrix data (0 or 1 values)."""
         # Basic shape validation before drawing
         if matrix_data.shape[0] != EXPECTED_ROWS or matrix_data.shape[1] != EXPECTED_COLS:
             print(f"Cannot update display: Matrix data has incorrect shape {matrix_data.shape}.")
             return
 
-        canvas.Clear() # Clear the entire canvas (sets all pixels to black/OFF)
-
-        # Iterate through the received matrix and set pixel colors on the canvas
-        for y in range(EXPECTED_ROWS):
-            for x in range(EXPECTED_COLS):
-                # If the value at this position is 255, set the pixel to the ON_COLOR
-                if matrix_data[y, x] == 255:
-                    canvas.SetPixel(x, y, *ON_COLOR)
-                # Pixels with value 0 are already OFF due to canvas.Clear()
+        # Build the full RGB frame with a single gather from the color LUT, using the pixel bits
+        # directly as indices: ON_COLOR where the value is 1, OFF_COLOR where it is 0.
+        # No canvas.Clear() needed since every pixel is overwritten by SetImage below.
+        # mode='clip' lets NumPy write into img_buf directly (the default 'raise' mode buffers `out`);
+        # it's safe because the indices are only ever 0 or 1.
+        np.take(self.color_lut, matrix_data, axis=0, out=self.img_buf, mode='clip')
+
+        # Blit the whole frame to the canvas in one call instead of one SetPixel per LED
+        canvas.SetImage(Image.fromarray(self.img_buf))
+
+    def refresh_display(self, offset_canvas, has_received_data):
+        """Draws the latest frame (or a blank screen before any data) and swaps it to the live display."""
+        if self.matrix is None or offset_canvas is None:
+            return offset_canvas
+        if has_received_data: # Only update if we've ever received valid data
+            # Draw the latest received matrix data onto the canvas
+            self.update_display(offset_canvas, self.display_matrix)
+        else:
+            # If no data yet, keep the display blank/black
+            offset_canvas.Clear()
+        # Swap the updated canvas to the live display, waits for vsync for smoothness
+        return self.matrix.SwapOnVSync(offset_canvas)
 
     def run(self):
         """Main loop for the LED receiver."""
@@ -161,57 +166,24 @@ class SocketLEDReceiver(SampleBase):
             print("Socket not listening, exiting.")
             return
 
-        print("Waiting for first connection and data...")
+        print("Waiting for first frame...")
         # Flag to track if we have received at least one valid frame
         has_received_data = False
 
         try:
             # --- Main Application Loop ---
             while True:
-                conn = None # Connection object
-                addr = None # Client address
-
-                try:
-                    # Attempt to accept a new connection. This will block for up to the set timeout (1s).
-                    # If a connection is accepted, process it. If it times out, the loop continues,
-                    # allowing the display to be refreshed with the last received data.
-                    conn, addr = self.server_socket.accept()
-
-                    if conn: # Check if a connection was successfully accepted
-                        # print(f"Connection accepted from {addr}") # Optional debug print
-                        # Receive the matrix data from the connected client
-                        received_matrix = self.receive_matrix_data(conn)
-
-                        if received_matrix is not None: # If data was received and validated
-                            self.display_matrix = received_matrix # Store it for display
-                            has_received_data = True # Mark that we have valid data
-                            # print("Successfully received and processed a frame.") # Optional debug print
-
-                        # Close the connection immediately after processing the frame's data
-                        try: conn.close()
-                        except Exception as e: print(f"Error closing connection from {addr}: {e}")
-
-                except socket.timeout:
-                    # Expected exception if no connection is made within the accept timeout
-                    pass # Just continue the loop to refresh display
-                except Exception as e:
-                    # Catch unexpected errors during connection handling
-                    print(f"Error during connection acceptance: {e}")
-                    traceback.print_exc()
-                    time.sleep(0.1) # Small delay to prevent rapid error looping
+                # Wait for the next frame. This blocks for up to the socket timeout (1s); if nothing
+                # arrives the loop continues, refreshing the display with the last received data.
+                received_matrix = self.receive_matrix_data()
+
+                if received_matrix is not None: # If data was received and validated
+                    self.display_matrix = received_matrix # Store it for display
+                    has_received_data = True # Mark that we have valid data
 
                 # --- Display Update Logic ---
                 # This section updates the physical LED matrix display
-                if self.matrix is not None and offset_canvas is not None:
-                    if has_received_data: # Only update if we've ever received valid data
-                        # Draw the latest received matrix data onto the canvas
-                        self.update_display(offset_canvas, self.display_matrix)
-                        # Swap the updated canvas to the live display, waits for vsync for smoothness
-                        offset_canvas = self.matrix.SwapOnVSync(offset_canvas)
-                    else:
-                        # If no data yet, keep the display blank/black
-                        offset_canvas.Clear()
-                        offset_canvas = self.matrix.SwapOnVSync(offset_canvas)
+                offset_canvas = self.refresh_display(offset_canvas, has_received_data)
 
         except KeyboardInterrupt:
             # Allows user to stop the script cleanly with Ctrl+C
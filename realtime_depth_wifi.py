@@ -1,16 +1,40 @@
 import cv2
 import torch
+import torch.nn.functional as F
 import numpy as np
 import sys
+import queue
 import socket
+import struct
+import threading
 import time
 import traceback
+import warnings
 
 from depth_anything_v2.dpt import DepthAnythingV2
+from depth_anything_v2.util.transform import Resize
+
+# Numba is optional: when installed, thresholding, scaling and rotation run as one fused kernel
+try:
+    from numba import config as numba_config, njit, prange
+    # The kernel runs on the inference thread; with the TBB layer that can hang interpreter exit
+    numba_config.THREADING_LAYER_PRIORITY = ["omp", "workqueue", "tbb"]
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
 
 # Specify the device to use ("cpu" or "mps" or "cuda")
 DEVICE = "mps"
 
+# Run the model in half precision on GPU backends (halves memory traffic, roughly doubles throughput)
+USE_HALF_PRECISION = DEVICE in ("mps", "cuda")
+MODEL_DTYPE = torch.float16 if USE_HALF_PRECISION else torch.float32
+
+# Model input resolution (same default as DepthAnythingV2.infer_image)
+INPUT_SIZE = 518
+INPUT_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+INPUT_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
 # Define the threshold to use for depths (percentage of closest depths to be considered "close")
 # Used to determine which depth values become 255 in the intermediate binary map.
 depth_threshold_percentage = 0.35
@@ -18,9 +42,25 @@ depth_threshold_percentage = 0.35
 LED_IP = "192.168.86.122"
 PORT = 8888
 
+# IP TOS byte for outgoing frames: DSCP EF ("expedited forwarding", 46 << 2). Wi-Fi WMM maps it to a
+# higher-priority access category, so frames don't wait behind bulk traffic on the air.
+FRAME_IP_TOS = 0xB8
+
+# Frame header sent before the pixels: rows and cols as little-endian 32-bit integers
+FRAME_HEADER = struct.Struct('<ii')
+
+# Unchanged frames aren't re-sent, except this often (seconds) in case the last datagram was lost
+RESEND_INTERVAL = 1.0
+
 TARGET_HEIGHT = 32
 TARGET_WIDTH = 32
 
+# Webcam capture settings. The model works at ~518px, so there's no point pulling 1080p over USB;
+# 640x480 also divides evenly into the 32x32 LED blocks.
+CAPTURE_WIDTH = 640
+CAPTURE_HEIGHT = 480
+CAPTURE_FPS = 30
+
 # --- Model Setup ---
 if not torch.backends.mps.is_available():
     print("Error: MPS is not available on this device.")
@@ -42,98 +82,326 @@ try:
     model = DepthAnythingV2(**model_configs[encoder])
     model.load_state_dict(torch.load(checkpoint_path, map_location=DEVICE))
     model = model.to(DEVICE).eval()
+    if USE_HALF_PRECISION:
+        model = model.half()
 except FileNotFoundError:
     print(f"Error: Checkpoint file not found at {checkpoint_path}")
     sys.exit(1)
 except Exception as e:
     print(f"Error loading model: {e}")
     sys.exit(1)
+
+# Same resizing rules as DepthAnythingV2.image2tensor, used here only to compute the input size
+input_resizer = Resize(
+    width=INPUT_SIZE,
+    height=INPUT_SIZE,
+    resize_target=False,
+    keep_aspect_ratio=True,
+    ensure_multiple_of=14,
+    resize_method='lower_bound',
+)
+
+# Input tensors keyed by model input size, reused across frames: (host staging tensor, device tensor)
+input_buffers = {}
+
+# TorchScript-traced copies of the model keyed by input size (a trace is specific to its input shape).
+# Running the traced graph avoids PyTorch's per-op Python dispatch on every frame.
+traced_models = {}
 # --- End Model Setup ---
 
 
+def get_input_buffers(input_height, input_width):
+    """Returns the host and device input tensors for this input size, allocating them on first use."""
+    key = (input_height, input_width)
+    if key not in input_buffers:
+        shape = (1, 3, input_height, input_width)
+        # Pinned host memory lets the CUDA upload run asynchronously (not supported on MPS)
+        host_input = torch.empty(shape, dtype=torch.float32, pin_memory=(DEVICE == "cuda"))
+        device_input = torch.empty(shape, dtype=MODEL_DTYPE, device=DEVICE)
+        input_buffers[key] = (host_input, device_input)
+    return input_buffers[key]
+
+def get_traced_model(device_input):
+    """Returns the model traced for this input's shape, tracing it on first use (eager model if tracing fails)."""
+    key = tuple(device_input.shape[-2:])
+    if key not in traced_models:
+        try:
+            with torch.no_grad(), warnings.catch_warnings():
+                # Shape-dependent Python branches get baked into the trace, which is fine for a fixed input size
+                warnings.simplefilter("ignore", torch.jit.TracerWarning)
+                traced_models[key] = torch.jit.trace(model, device_input, check_trace=False)
+        except Exception as e:
+            print(f"Warning: Could not trace the depth model, running it eagerly: {e}")
+            traced_models[key] = model
+    return traced_models[key]
+
+def warm_up_model(frame_height, frame_width):
+    """Traces and runs the model once for this frame size so the first real frame isn't slowed down."""
+    if frame_height <= 0 or frame_width <= 0:
+        # Some capture backends don't report a frame size; the model is traced on the first frame instead
+        print("Camera did not report its frame size, skipping model warm-up.")
+        return
+    input_width, input_height = input_resizer.get_size(frame_width, frame_height)
+    _, device_input = get_input_buffers(input_height, input_width)
+    device_input.zero_()
+    with torch.no_grad():
+        get_traced_model(device_input)(device_input)
+
 def create_depth_map(frame):
-    """Generates a depth map from a given frame."""
+    """
+    Generates a depth map from a given frame.
+    Equivalent to model.infer_image(frame), but feeds the traced model in MODEL_DTYPE
+    through preallocated input tensors.
+    """
+    height, width = frame.shape[:2]
+    input_width, input_height = input_resizer.get_size(width, height)
+
+    # BGR -> RGB in [0, 1], resize to the model input size, then normalize
+    image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
+    image = cv2.resize(image, (input_width, input_height), interpolation=cv2.INTER_CUBIC)
+    image -= INPUT_MEAN
+    image /= INPUT_STD
+
+    host_input, device_input = get_input_buffers(input_height, input_width)
+    host_input[0].copy_(torch.from_numpy(image).permute(2, 0, 1))
+    device_input.copy_(host_input, non_blocking=True)
+
     with torch.no_grad():
-        depth = model.infer_image(frame)
-    return depth
+        depth = get_traced_model(device_input)(device_input)
+        depth = F.interpolate(depth[:, None], (height, width), mode="bilinear", align_corners=True)[0, 0]
+    return depth.float().cpu().numpy()
+
+def compute_depth_threshold(depth_map, threshold_percentage):
+    """
+    Returns the depth value at the given percentile of the depth map.
+    The percentile is estimated on every 4th pixel in each direction, which is
+    plenty given the map is later reduced to 32x32.
+    """
+    sample = depth_map[::4, ::4].ravel()
+    threshold_index = int(threshold_percentage * sample.size)
+    threshold_index = min(max(0, threshold_index), sample.size - 1)
+    return np.partition(sample, threshold_index)[threshold_index]
 
 def convert_to_binary(depth_map, threshold_percentage):
     """
     Converts a depth map to an inverted binary map based on a threshold percentage.
     Pixels with depth > percentile threshold become 255, others become 0.
     """
-    flattened_depth = depth_map.flatten()
-    if len(flattened_depth) == 0:
+    if depth_map.size == 0:
         print("Warning: Empty depth map received in convert_to_binary.")
         return np.zeros_like(depth_map, dtype=np.uint8)
 
-    threshold_index = int(threshold_percentage * len(flattened_depth))
-    threshold_index = min(max(0, threshold_index), len(flattened_depth) - 1)
-    threshold_depth = np.partition(flattened_depth, threshold_index)[threshold_index]
-
-    binary_depth_map = np.zeros_like(depth_map, dtype=np.uint8)
-    binary_depth_map[depth_map > threshold_depth] = 255
-    binary_depth_map[depth_map <= threshold_depth] = 0
+    threshold_depth = compute_depth_threshold(depth_map, threshold_percentage)
 
-    return binary_depth_map
+    return np.multiply(depth_map > threshold_depth, 255, dtype=np.uint8, casting='unsafe')
 
-def scale_binary_matrix_threshold_kernel(matrix, target_height, target_width, on_threshold_255_percentage):
+def scale_binary_matrix_threshold_kernel(matrix, target_height, target_width, on_threshold_255_percentage, rotate_clockwise=False):
     """
     Scales a binary matrix to a target size using a threshold kernel approach.
     Outputs 255 if the percentage of 255s in the corresponding block >= threshold.
+    Any rows/columns that don't divide evenly into the target size are cropped.
+    With rotate_clockwise, the result is written out already rotated 90 degrees
+    clockwise (same as np.rot90(result, k=-1)), with shape (target_width, target_height).
     """
     original_height, original_width = matrix.shape
-    scaled_matrix = np.zeros((target_height, target_width), dtype=np.uint8)
-
-    height_ratio = original_height / target_height
-    width_ratio = original_width / target_width
-
-    for y in range(target_height):
-        for x in range(target_width):
-            start_y = int(y * height_ratio)
-            end_y = int((y + 1) * height_ratio)
-            start_x = int(x * width_ratio)
-            end_x = int((x + 1) * width_ratio)
-
-            block = matrix[start_y:end_y, start_x:end_x]
-
-            if block.size > 0:
-                count_of_255s = np.sum(block == 255)
-                block_size = block.size
-                percentage_of_255s = count_of_255s / block_size
-
-                if percentage_of_255s >= on_threshold_255_percentage:
-                     scaled_matrix[y, x] = 255
+    block_height = original_height // target_height
+    block_width = original_width // target_width
+
+    if block_height == 0 or block_width == 0:
+        out_shape = (target_width, target_height) if rotate_clockwise else (target_height, target_width)
+        return np.zeros(out_shape, dtype=np.uint8)
+
+    # Crop to a whole number of blocks so INTER_AREA averages exactly one block per output pixel.
+    # Resizing a float32 0/1 mask gives each block's percentage of 255s without rounding it to
+    # an integer, so blocks exactly at the threshold turn ON just like in the Numba kernel.
+    cropped = matrix[:target_height * block_height, :target_width * block_width]
+    percentage_of_255s = cv2.resize((cropped == 255).astype(np.float32), (target_width, target_height), interpolation=cv2.INTER_AREA)
+
+    if rotate_clockwise:
+        # Transpose + horizontal flip is a zero-copy view; thresholding it writes the rotated result directly
+        percentage_of_255s = percentage_of_255s.T[:, ::-1]
+
+    return np.multiply(percentage_of_255s >= on_threshold_255_percentage, 255, dtype=np.uint8, casting='unsafe', order='C')
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def depth_to_led(depth_map, threshold_depth, on_threshold_255_percentage, out):
+        """
+        Fused equivalent of convert_to_binary -> scale_binary_matrix_threshold_kernel -> np.rot90(k=-1).
+        Counts the pixels deeper than threshold_depth in each block of the raw depth map and
+        writes 255/0 straight into the rotated output, which has shape (target_width, target_height).
+        """
+        target_width, target_height = out.shape
+        block_height = depth_map.shape[0] // target_height
+        block_width = depth_map.shape[1] // target_width
+        block_size = block_height * block_width
+
+        for y in prange(target_height):
+            for x in range(target_width):
+                count = 0
+                for i in range(y * block_height, (y + 1) * block_height):
+                    for j in range(x * block_width, (x + 1) * block_width):
+                        if depth_map[i, j] > threshold_depth:
+                            count += 1
+                # Rotating 90 degrees clockwise moves (y, x) to (x, target_height - 1 - y)
+                if block_size > 0 and count / block_size >= on_threshold_255_percentage:
+                    out[x, target_height - 1 - y] = 255
                 else:
-                     scaled_matrix[y, x] = 0
-            else:
-                scaled_matrix[y, x] = 0
+                    out[x, target_height - 1 - y] = 0
 
-    return scaled_matrix
+def depth_map_to_led_matrix(depth_map, on_threshold_255_percentage):
+    """
+    Turns a full-resolution depth map into the rotated TARGET_HEIGHT x TARGET_WIDTH
+    0/255 matrix sent to the LEDs. Uses the fused Numba kernel when available.
+    """
+    # Binary threshold: 255 for farthest 35%, 0 for closest 65%
+    threshold_percentage = 1 - depth_threshold_percentage
+
+    if NUMBA_AVAILABLE and depth_map.size > 0:
+        threshold_depth = compute_depth_threshold(depth_map, threshold_percentage)
+        rotated_binary_map = np.empty((TARGET_WIDTH, TARGET_HEIGHT), dtype=np.uint8)
+        depth_to_led(depth_map, threshold_depth, on_threshold_255_percentage, rotated_binary_map)
+        return rotated_binary_map
+
+    binary_depth_map = convert_to_binary(depth_map, threshold_percentage)
+
+    # Scale to 32x32 using ON_THRESHOLD to determine ON/OFF pixels, and
+    # rotate 90 degrees clockwise (since I messed up assembling the LEDs :) )
+    return scale_binary_matrix_threshold_kernel(
+        binary_depth_map,
+        TARGET_HEIGHT,
+        TARGET_WIDTH,
+        on_threshold_255_percentage=on_threshold_255_percentage,
+        rotate_clockwise=True
+    )
+
+# UDP socket used for every frame sent to the LED receiver: created on first send, recreated after errors
+led_sender = {"socket": None}
+
+def get_led_socket():
+    """Returns the UDP socket used to send frames, creating it if needed."""
+    if led_sender["socket"] is None:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Mark frames as latency-sensitive; best effort, since not every OS/network honours it
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, FRAME_IP_TOS)
+        except (AttributeError, OSError):
+            pass
+        led_sender["socket"] = s
+    return led_sender["socket"]
+
+def close_led_socket():
+    """Closes the sending socket so the next send creates a fresh one."""
+    s = led_sender["socket"]
+    led_sender["socket"] = None
+    if s is not None:
+        try:
+            s.close()
+        except OSError:
+            pass
 
 def send_over_wifi(binary_matrix, LED_IP, port):
-    """Sends a binary matrix over Wi-Fi."""
+    """
+    Sends a binary matrix over Wi-Fi as a single UDP datagram.
+    Fire-and-forget: a lost frame is simply replaced by the next one.
+    """
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(1)
-            s.connect((LED_IP, port))
-            rows, cols = binary_matrix.shape
-            s.sendall(rows.to_bytes(4, 'little'))
-            s.sendall(cols.to_bytes(4, 'little'))
-            for row in binary_matrix:
-                for element in row:
-                    s.sendall(int(element).to_bytes(4, 'little'))
-            return True
-
-    except (ConnectionRefusedError, socket.timeout, socket.gaierror):
+        s = get_led_socket()
+        rows, cols = binary_matrix.shape
+        # Header (rows, cols) followed by the pixels bit-packed, 8 per byte (1 = 255/ON), row-major
+        header = FRAME_HEADER.pack(rows, cols)
+        payload = np.packbits(binary_matrix == 255).tobytes()
+        s.sendto(header + payload, (LED_IP, port))
+        return True
+
+    except OSError:
+        # Network down, receiver unreachable or address not resolvable (ENETUNREACH, EHOSTUNREACH,
+        # ConnectionRefusedError, gaierror, ...): just drop this frame. The UDP socket itself is
+        # still usable, so keep it for the next frame.
         return False
     except Exception as e:
         print(f"An unexpected error occurred during sending: {e}")
+        close_led_socket()
         return False
 
+# --- Pipeline Stages ---
+# Capture, inference and sending each run in their own thread, connected by size-1 queues,
+# so frame N+1 is captured while frame N is on the GPU and frame N-1 is on the network.
+# cv2, torch and socket calls release the GIL, so the stages genuinely overlap.
+
+def put_latest(q, item):
+    """Puts item on a size-1 queue, dropping any stale item still waiting there."""
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+def run_stage(name, stop_event, stage, *args):
+    """Runs a pipeline stage, stopping the whole pipeline if it fails."""
+    try:
+        stage(stop_event, *args)
+    except Exception as e:
+        print(f"An unexpected error occurred in the {name} stage: {e}")
+        traceback.print_exc()
+    finally:
+        stop_event.set()
+
+def capture_loop(stop_event, cap, frame_queue):
+    """Reads webcam frames and keeps only the newest one queued for inference."""
+    while not stop_event.is_set():
+        ret, frame = cap.read()
+
+        if not ret:
+            print("Error: Could not read frame. Exiting.")
+            return
+
+        put_latest(frame_queue, frame)
+
+def inference_loop(stop_event, frame_queue, led_queue, on_threshold):
+    """Turns queued frames into rotated 32x32 binary maps ready to send."""
+    while not stop_event.is_set():
+        try:
+            frame = frame_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+        depth_map = create_depth_map(frame)
+
+        # Threshold, scale to 32x32 and rotate to match the physical panel
+        put_latest(led_queue, depth_map_to_led_matrix(depth_map, on_threshold))
+
+def send_loop(stop_event, led_queue):
+    """Sends each queued binary map to the LED matrix, skipping ones identical to the last frame sent."""
+    last_sent_bytes = None
+    last_sent_time = 0.0
+
+    while not stop_event.is_set():
+        try:
+            rotated_binary_map = led_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+        # Static scenes produce the same 32x32 map frame after frame; comparing 1 KB is far
+        # cheaper than the send and the redraw on the Pi
+        frame_bytes = rotated_binary_map.tobytes()
+        now = time.monotonic()
+        if frame_bytes == last_sent_bytes and now - last_sent_time < RESEND_INTERVAL:
+            continue
+
+        if send_over_wifi(rotated_binary_map, LED_IP, PORT):
+            last_sent_bytes = frame_bytes
+            last_sent_time = now
+
 def main():
     """Captures webcam feed, processes, and sends binary matrix over Wi-Fi."""
     cap = None
+    stop_event = threading.Event()
+    threads = []
 
     # Threshold for turning ON LEDs (percentage of 255s required in the source block)
     # A higher value biases towards fewer ON LEDs.
@@ -146,30 +414,34 @@ def main():
             print("Error: Could not open webcam.")
             sys.exit(1) # Exit immediately if no webcam
 
-        while True:
-            ret, frame = cap.read()
-
-            if not ret:
-                print("Error: Could not read frame. Exiting.")
-                break
-
-            depth_map = create_depth_map(frame)
-
-            # Convert to binary: 255 for farthest 35%, 0 for closest 65%
-            binary_depth_map = convert_to_binary(depth_map, (1-depth_threshold_percentage))
-
-            # Scale to 32x32 using ON_THRESHOLD to determine ON/OFF pixels
-            scaled_binary_map = scale_binary_matrix_threshold_kernel(
-                binary_depth_map,
-                TARGET_HEIGHT,
-                TARGET_WIDTH,
-                on_threshold_255_percentage=ON_THRESHOLD
-            )
-
-            # Rotate 90 degrees clockwise (since I messed up assembling the LEDs :) )
-            rotated_binary_map = np.rot90(scaled_binary_map, k=-1)
-
-            send_over_wifi(rotated_binary_map, LED_IP, PORT)
+        # Ask for compressed MJPEG at a modest resolution instead of the driver's default
+        # (often uncompressed YUYV at full resolution). Cameras ignore settings they don't support.
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAPTURE_WIDTH)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAPTURE_HEIGHT)
+        cap.set(cv2.CAP_PROP_FPS, CAPTURE_FPS)
+        # Keep at most one frame queued in the driver so cap.read() returns a fresh frame
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        # Trace the model for the resolution the camera actually delivers before frames start flowing
+        print("Preparing depth model...")
+        warm_up_model(int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)))
+
+        # maxsize=1: a slow stage always picks up the most recent item instead of a backlog
+        frame_queue = queue.Queue(maxsize=1)
+        led_queue = queue.Queue(maxsize=1)
+
+        threads = [
+            threading.Thread(target=run_stage, args=("capture", stop_event, capture_loop, cap, frame_queue), daemon=True),
+            threading.Thread(target=run_stage, args=("inference", stop_event, inference_loop, frame_queue, led_queue, ON_THRESHOLD), daemon=True),
+            threading.Thread(target=run_stage, args=("send", stop_event, send_loop, led_queue), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        # Wait in short slices so Ctrl+C is handled promptly
+        while not stop_event.is_set():
+            stop_event.wait(0.5)
 
     except KeyboardInterrupt:
         print("\nProcessing interrupted by user.")
@@ -177,6 +449,10 @@ def main():
         print(f"An unexpected error occurred: {e}")
         traceback.print_exc()
     finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join(timeout=2.0)
+        close_led_socket()
         if cap is not None:
             cap.release()
         cv2.destroyAllWindows()